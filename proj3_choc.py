@@ -6,8 +6,17 @@
 
 import sqlite3
 import re
+import csv
+import importlib.util
+import os
+import signal
+import sys
+import threading
+import time
+import uuid
 import plotly.graph_objects as go
 from collections import defaultdict
+from functools import partial
 
 
 # proj3_choc.py
@@ -17,10 +26,26 @@ from collections import defaultdict
 
 # Part 1: Read data from a database called choc.db
 DBNAME = 'choc.sqlite'
+# FTS5 index over bar and company names, backing the "search" command.
+SEARCH_TABLE = 'BarsSearch'
+
+# Per-entry-point query time budgets in seconds (None: no deadline), looked up at call time.
+# "prompt" is used by interactive_prompt(.), "batch" by process_commands(.), and "server" is
+# meant for callers embedding process_command(.) in a server.
+QUERY_TIMEOUTS = {"prompt": 5.0, "batch": 60.0, "server": 2.0}
+# Number of SQLite VM instructions between two deadline checks.
+PROGRESS_INTERVAL = 10000
+
+# Export formats by file extension, and number of records fetched per written batch.
+EXPORT_FORMATS = {".csv": "csv", ".arrow": "arrow", ".ipc": "arrow", ".feather": "arrow", ".parquet": "parquet"}
+EXPORT_BATCH_SIZE = 65536
+# Per-entry-point time budgets of commands with an "export" parameter, since extracts may take much
+# longer than interactive queries. Entry points missing here, such as "server", can't export.
+EXPORT_TIMEOUTS = {"prompt": 600.0, "batch": 600.0}
 
 
 # Part 1: Implement logic to process user commands
-def process_command(command):
+def process_command(command, timeout=None, cancellable=False, entry_point=None):
     """
     Take a str user input, return a list of records.
 
@@ -28,14 +53,21 @@ def process_command(command):
     ----------
     command: str
         Raw user input.
+    timeout: float or None
+        Time budget of the query in seconds. If None, the budget of "entry_point" is used.
+    cancellable: bool
+        If True, Ctrl-C cancels the running query instead of propagating KeyboardInterrupt.
+        Only takes effect in the main thread.
+    entry_point: str or None
+        Key of QUERY_TIMEOUTS, or of EXPORT_TIMEOUTS for commands with an "export" parameter.
+        If both "timeout" and "entry_point" are None, there is no deadline.
 
     Returns
     -------
-    list
-        List of records as tuples.
+    list or int
+        List of records as tuples. If the command has an "export" parameter, the records are
+        written to that file instead and the number of exported records is returned.
     """
-    conn = sqlite3.connect(DBNAME)
-    cur = conn.cursor()
     try:
         parsed_dict = extract_and_group_commands(command)
     except InvalidInputError as e:
@@ -55,18 +87,385 @@ def process_command(command):
             query = query_countries(parsed_dict, command)
         elif high_level == "regions":
             query = query_regions(parsed_dict, command)
+        elif high_level == "search":
+            query = query_search(parsed_dict, command)
     except InvalidInputError as e:
         # print(e)
         # return []
         raise e
 
-    cur.execute(query)
-    results = list(cur.fetchall())
-    conn.close()
+    if parsed_dict["export"] is None:
+        timeouts = QUERY_TIMEOUTS
+    else:
+        if entry_point is not None and entry_point not in EXPORT_TIMEOUTS:
+            raise ExportError(f"Exports are not available from {entry_point}: {command}")
+        check_export(parsed_dict["export"])
+        timeouts = EXPORT_TIMEOUTS
+    if timeout is None and entry_point is not None:
+        timeout = timeouts[entry_point]
+
+    conn = sqlite3.connect(DBNAME)
+    try:
+        if high_level == "search" and not has_search_index(conn):
+            raise SearchIndexError()
+        if parsed_dict["export"] is None:
+            fetch = None
+        else:
+            fetch = partial(export_records, path=parsed_dict["export"], columns=export_columns(parsed_dict))
+        results = execute_with_deadline(conn, query, command, timeout=timeout, cancellable=cancellable,
+                                        fetch=fetch)
+    finally:
+        conn.close()
 
     return results
 
 
+def process_commands(commands, timeout=None):
+    """
+    Batch entry point: run several user commands, each one under its own time budget.
+
+    Parameters
+    ----------
+    commands: list
+        List of raw user inputs.
+    timeout: float or None
+        Time budget of each query in seconds. If None, QUERY_TIMEOUTS["batch"] is used.
+
+    Returns
+    -------
+    list
+        List of results of process_command(.), one per command.
+    """
+    return [process_command(command, timeout=timeout, entry_point="batch") for command in commands]
+
+
+def execute_with_deadline(conn, query, cmd, timeout=None, cancellable=False, fetch=None):
+    """
+    Execute a query and fetch all records, aborting it through SQLite's progress handler
+    once the deadline passes or, if cancellable, when the user presses Ctrl-C.
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection
+        Connection used to run the query.
+    query: str
+        The SQL to execute.
+    cmd: str
+        Original command used for error message.
+    timeout: float or None
+        Time budget of the query in seconds. None means no deadline.
+    cancellable: bool
+        Whether Ctrl-C cancels the query. Only takes effect in the main thread.
+    fetch: callable or None
+        Consumes the executed cursor, e.g. to stream records elsewhere. None means fetching all records.
+
+    Returns
+    -------
+    list or raise QueryTimeoutError / QueryCancelledError
+        List of records as tuples, or the return value of "fetch".
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    status = {"timed_out": False, "cancelled": False}
+
+    def progress_handler():
+        if deadline is not None and time.monotonic() > deadline:
+            status["timed_out"] = True
+            return 1
+        return 0
+
+    def sigint_handler(signum, frame):
+        status["cancelled"] = True
+        conn.interrupt()
+
+    cancellable = cancellable and threading.current_thread() is threading.main_thread()
+    if deadline is not None or cancellable:
+        # a Python-level handler also gives pending signal handlers a chance to run mid-query
+        conn.set_progress_handler(progress_handler, PROGRESS_INTERVAL)
+    if cancellable:
+        prev_sigint_handler = signal.signal(signal.SIGINT, sigint_handler)
+
+    cur = conn.cursor()
+    try:
+        cur.execute(query)
+        if fetch is None:
+            results = list(cur.fetchall())
+        else:
+            results = fetch(cur)
+    except sqlite3.OperationalError as e:
+        if status["cancelled"]:
+            raise QueryCancelledError(f"Query cancelled: {cmd}") from e
+        if status["timed_out"]:
+            raise QueryTimeoutError(f"Query exceeded time budget of {timeout}s: {cmd}") from e
+        raise e
+    finally:
+        if cancellable:
+            signal.signal(signal.SIGINT, prev_sigint_handler)
+        conn.set_progress_handler(None, 0)
+
+    return results
+
+
+def build_search_index(dbname=None):
+    """
+    One-time setup for the "search" command: create the FTS5 index over Bars if it doesn't exist yet.
+    The index stores no copy of the text (external content) and triggers keep it in sync with later
+    changes to Bars. Safe to run from several processes at once.
+
+    Parameters
+    ----------
+    dbname: str or None
+        Path to the database. None means DBNAME.
+
+    Returns
+    -------
+    bool
+        Whether the index was built by this call.
+    """
+    conn = sqlite3.connect(DBNAME if dbname is None else dbname, isolation_level=None)
+    cur = conn.cursor()
+    try:
+        # take the write lock before checking, so that concurrent builds don't race
+        cur.execute("BEGIN IMMEDIATE")
+        if has_search_index(conn):
+            cur.execute("ROLLBACK")
+            return False
+
+        # prefix indexes serve the prefix queries of query_search(.); the update trigger only
+        # fires for the indexed columns, so e.g. rating edits don't rewrite the index
+        statements = [
+            f"""CREATE VIRTUAL TABLE {SEARCH_TABLE} USING fts5(
+                SpecificBeanBarName, Company, content='Bars', content_rowid='Id', prefix='2 3'
+            )""",
+            f"INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}) VALUES ('rebuild')",
+            f"""CREATE TRIGGER {SEARCH_TABLE}_ai AFTER INSERT ON Bars BEGIN
+                INSERT INTO {SEARCH_TABLE}(rowid, SpecificBeanBarName, Company)
+                VALUES (new.Id, new.SpecificBeanBarName, new.Company);
+            END""",
+            f"""CREATE TRIGGER {SEARCH_TABLE}_ad AFTER DELETE ON Bars BEGIN
+                INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}, rowid, SpecificBeanBarName, Company)
+                VALUES ('delete', old.Id, old.SpecificBeanBarName, old.Company);
+            END""",
+            f"""CREATE TRIGGER {SEARCH_TABLE}_au AFTER UPDATE OF SpecificBeanBarName, Company ON Bars BEGIN
+                INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}, rowid, SpecificBeanBarName, Company)
+                VALUES ('delete', old.Id, old.SpecificBeanBarName, old.Company);
+                INSERT INTO {SEARCH_TABLE}(rowid, SpecificBeanBarName, Company)
+                VALUES (new.Id, new.SpecificBeanBarName, new.Company);
+            END""",
+        ]
+        try:
+            for statement in statements:
+                cur.execute(statement)
+        except BaseException:
+            cur.execute("ROLLBACK")
+            raise
+        cur.execute("COMMIT")
+    finally:
+        conn.close()
+
+    return True
+
+
+def has_search_index(conn):
+    """
+    Check whether build_search_index(.) has been run on the database.
+
+    Parameters
+    ----------
+    conn: sqlite3.Connection
+        Connection to the database.
+
+    Returns
+    -------
+    bool
+    """
+    cur = conn.cursor()
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (SEARCH_TABLE,))
+
+    return cur.fetchone() is not None
+
+
+def export_columns(parsed_dict):
+    """
+    Names and types of the exported columns, matching the records of the high-level command.
+
+    Parameters
+    ----------
+    parsed_dict: dict
+        Parsed command from extract_and_group_commands(.).
+
+    Returns
+    -------
+    list
+        List of (name, type) tuples, type being a pyarrow type factory name.
+    """
+    high_level = parsed_dict["high_level"]
+    if high_level in ["bars", "search"]:
+        return [("SpecificBeanBarName", "string"), ("Company", "string"), ("CompanyLocation", "string"),
+                ("Rating", "float64"), ("CocoaPercent", "float64"), ("BroadBeanOrigin", "string")]
+
+    group3 = parsed_dict["groups"][2]
+    _, key = AGGREGATES[group3]
+    aggregate = (key, "int64" if group3 == "number_of_bars" else "float64")
+    if high_level == "companies":
+        return [("Company", "string"), ("CompanyLocation", "string"), aggregate]
+    elif high_level == "countries":
+        return [("Country", "string"), ("Region", "string"), aggregate]
+    elif high_level == "regions":
+        return [("Region", "string"), aggregate]
+
+
+def check_export(path):
+    """
+    Check that the records can be exported to "path" before running the query.
+
+    Parameters
+    ----------
+    path: str
+        Output file. Its extension selects the format, see EXPORT_FORMATS.
+
+    Returns
+    -------
+    None or raise ExportError
+    """
+    export_format = EXPORT_FORMATS[os.path.splitext(path)[1].lower()]
+    if export_format != "csv" and importlib.util.find_spec("pyarrow") is None:
+        raise ExportError(f"Exporting to {path} requires pyarrow, which is not installed")
+
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.isdir(directory) or not os.access(directory, os.W_OK):
+        raise ExportError(f"Cannot write to directory {directory}")
+    if os.path.isdir(path):
+        raise ExportError(f"Cannot export to directory {path}")
+
+
+def export_records(cur, path, columns, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Stream the records of an executed cursor into a CSV, Arrow IPC or Parquet file, holding at most
+    one batch of records in memory. Records are written to a temporary file next to "path", which
+    replaces "path" only once the export succeeded, so a failed export leaves "path" untouched.
+
+    Parameters
+    ----------
+    cur: sqlite3.Cursor
+        Executed cursor.
+    path: str
+        Output file. Its extension selects the format, see EXPORT_FORMATS.
+    columns: list
+        Column names and types from export_columns(.).
+    batch_size: int
+        Number of records per batch.
+
+    Returns
+    -------
+    int or raise ExportError
+        Number of exported records.
+    """
+    export_format = EXPORT_FORMATS[os.path.splitext(path)[1].lower()]
+    directory, filename = os.path.split(os.path.abspath(path))
+    tmp_path = os.path.join(directory, f".{filename}.{uuid.uuid4().hex}.tmp")
+    try:
+        if export_format == "csv":
+            num_records = write_csv_batches(cur, tmp_path, columns, batch_size)
+        else:
+            num_records = write_arrow_batches(cur, tmp_path, columns, export_format, batch_size)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        raise ExportError(f"Export to {path} failed: {e}") from e
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    return num_records
+
+
+def write_csv_batches(cur, path, columns, batch_size):
+    """
+    Helper function for export_records(.). Writes the records of an executed cursor as CSV.
+
+    Parameters
+    ----------
+    cur: sqlite3.Cursor
+        Executed cursor.
+    path: str
+        Output file.
+    columns: list
+        Column names and types from export_columns(.).
+    batch_size: int
+        Number of records per batch.
+
+    Returns
+    -------
+    int
+        Number of written records.
+    """
+    num_records = 0
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow([name for name, _ in columns])
+        while True:
+            records = cur.fetchmany(batch_size)
+            if len(records) == 0:
+                break
+            writer.writerows(records)
+            num_records += len(records)
+
+    return num_records
+
+
+def write_arrow_batches(cur, path, columns, export_format, batch_size):
+    """
+    Helper function for export_records(.). Writes the records of an executed cursor as typed
+    Arrow IPC or Parquet record batches.
+
+    Parameters
+    ----------
+    cur: sqlite3.Cursor
+        Executed cursor.
+    path: str
+        Output file.
+    columns: list
+        Column names and types from export_columns(.).
+    export_format: str
+        "arrow" or "parquet".
+    batch_size: int
+        Number of records per batch.
+
+    Returns
+    -------
+    int or raise ExportError
+        Number of written records.
+    """
+    # optional dependency, only needed for Arrow IPC and Parquet
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise ExportError(f"Exporting to {export_format} requires pyarrow, which is not installed") from e
+
+    num_records = 0
+    try:
+        schema = pa.schema([(name, getattr(pa, type_name)()) for name, type_name in columns])
+        if export_format == "parquet":
+            writer = pq.ParquetWriter(path, schema)
+        else:
+            writer = pa.ipc.new_file(path, schema)
+        try:
+            while True:
+                records = cur.fetchmany(batch_size)
+                if len(records) == 0:
+                    break
+                # transpose the batch of records into one array per column
+                arrays = [pa.array(values, type=field.type) for values, field in zip(zip(*records), schema)]
+                writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+                num_records += len(records)
+        finally:
+            writer.close()
+    except pa.ArrowException as e:
+        raise ExportError(f"Export to {export_format} failed: {e}") from e
+
+    return num_records
+
+
 class InvalidInputError(Exception):
     """
     A custom exception for invalid user input.
@@ -75,6 +474,38 @@ class InvalidInputError(Exception):
         super().__init__(msg)
 
 
+class SearchIndexError(Exception):
+    """
+    A custom exception for "search" commands run before build_search_index(.).
+    """
+    def __init__(self, msg="Search index missing, build it once with: python proj3_choc.py build_search_index"):
+        super().__init__(msg)
+
+
+class ExportError(Exception):
+    """
+    A custom exception for records that can't be exported.
+    """
+    def __init__(self, msg="Export failed"):
+        super().__init__(msg)
+
+
+class QueryTimeoutError(Exception):
+    """
+    A custom exception for queries exceeding their time budget.
+    """
+    def __init__(self, msg="Query exceeded time budget"):
+        super().__init__(msg)
+
+
+class QueryCancelledError(Exception):
+    """
+    A custom exception for queries cancelled by the user.
+    """
+    def __init__(self, msg="Query cancelled"):
+        super().__init__(msg)
+
+
 def extract_and_group_commands(user_in):
     """
     Helper function to check and extract high-level command.
@@ -92,7 +523,9 @@ def extract_and_group_commands(user_in):
         {"high_level": str,
         "groups": list[str],
         "is_user_input": list[int] (-1: no user input, others: user input),
-        "barplot": bool}
+        "barplot": bool,
+        "terms": list[str] (search terms, only for "search"),
+        "export": str or None (path to export the records to)}
     """
     user_in = user_in.strip()
     parsed_syms = user_in.split(" ")
@@ -103,7 +536,7 @@ def extract_and_group_commands(user_in):
         raise InvalidInputError(error_msg)
 
     # extract high-level command
-    high_level_syms = ["bars", "companies", "countries", "regions"]
+    high_level_syms = ["bars", "companies", "countries", "regions", "search"]
     high_level_ind = extract_args(high_level_syms, parsed_syms)
     if high_level_ind == -2 or high_level_ind > 0:  # multiple or not the first one
         raise InvalidInputError(error_msg)
@@ -191,8 +624,24 @@ def extract_and_group_commands(user_in):
         group6 = True
         processed_inds.append(group6_ind)
 
-    # finally there should be no unprocessed parts of the user input
-    if not len(processed_inds) == len(parsed_syms):
+    # extract export param
+    group7_ind = extract_kwargs(re.compile(r"export=.+"), parsed_syms)
+    if group7_ind == -2 or (group7_ind != -1 and group6):  # can't export a barplot
+        raise InvalidInputError(error_msg)
+    elif group7_ind == -1:
+        group7 = None
+    else:
+        group7 = parsed_syms[group7_ind].split("=", 1)[1]
+        if os.path.splitext(group7)[1].lower() not in EXPORT_FORMATS:
+            raise InvalidInputError(error_msg)
+        processed_inds.append(group7_ind)
+
+    # finally there should be no unprocessed parts of the user input, except search terms
+    terms = [sym for i, sym in enumerate(parsed_syms) if i not in processed_inds]
+    if high_level == "search":
+        if len(terms) == 0 or "" in terms:
+            raise InvalidInputError(error_msg)
+    elif not len(processed_inds) == len(parsed_syms):
         # return None
         raise InvalidInputError(error_msg)
 
@@ -200,7 +649,9 @@ def extract_and_group_commands(user_in):
     parsed_dict = {"high_level": high_level,
                    "groups": [group1, group2, group3, group4, group5],
                    "is_user_input": [group1_ind, group2_ind, group3_ind, group4_ind, group5_ind],
-                   "barplot": group6}
+                   "barplot": group6,
+                   "terms": terms,
+                   "export": group7}
 
     return parsed_dict
 
@@ -263,6 +714,117 @@ def extract_args(args, syms):
     return group_ind
 
 
+# Roles the Countries table plays for a bar, keyed by group 2 parameter.
+COUNTRY_ALIASES = {"sell": "C_companies", "source": "C_beans"}
+# Foreign key of Bars each Countries alias is joined on.
+COUNTRY_KEYS = {"C_companies": "B.CompanyLocationId", "C_beans": "B.BroadBeanOriginId"}
+# Countries column each group 1 keyword filters on.
+FILTER_COLUMNS = {"country": "Alpha2", "region": "Region"}
+# Group 3 parameters: (aggregate, alias) for grouped commands.
+AGGREGATES = {"ratings": ("AVG(Rating)", "R_AVG"),
+              "cocoa": ("AVG(CocoaPercent)", "CP_AVG"),
+              "number_of_bars": ("COUNT(SpecificBeanBarName)", "B_CNT")}
+# Group 3 parameters: sort column of bar records.
+BAR_KEYS = {"ratings": "Rating", "cocoa": "CocoaPercent"}
+# Columns of a bar record.
+BAR_COLUMNS = ["SpecificBeanBarName", "Company", "C_companies.EnglishName", "Rating", "CocoaPercent",
+               "C_beans.EnglishName"]
+# Group 4 parameters.
+ORDERS = {"top": "DESC", "bottom": "ASC"}
+# Only report groups with enough bars.
+MIN_BARS_HAVING = "COUNT(SpecificBeanBarName) > 4"
+
+
+def build_query(select, filters=(), match=None, group_by=None, having=None, order_by=None, order="DESC",
+                limit=None, restrict=tuple(COUNTRY_KEYS)):
+    """
+    Assemble a SELECT over Bars from a query plan. Countries is joined only under the aliases
+    that are actually referenced, and filters are pushed down to Bars as semi-joins on the
+    foreign keys, so they apply before any join.
+
+    Parameters
+    ----------
+    select: list
+        Column expressions, possibly qualified with an alias of COUNTRY_KEYS.
+    filters: list
+        (alias, column, value) tuples restricting Countries under the given alias.
+    match: str or None
+        FTS5 query restricting Bars through the search index.
+    group_by: str or None
+        GROUP BY expression.
+    having: str or None
+        HAVING condition.
+    order_by: str or None
+        ORDER BY key.
+    order: str
+        "ASC" or "DESC".
+    limit: int or None
+        Maximum number of records.
+    restrict: tuple
+        Aliases whose foreign key must resolve to a country, as an inner join would require.
+
+    Returns
+    -------
+    query: str
+        The SQL for the plan.
+    """
+    referenced = " ".join(list(select) + [group_by or "", having or "", order_by or ""])
+    aliases = [alias for alias in COUNTRY_KEYS if f"{alias}." in referenced]
+
+    conditions = []
+    if match is not None:
+        match = match.replace("'", "''")
+        conditions.append(f"B.Id IN (SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH '{match}')")
+    for alias, column, value in filters:
+        value = value.replace("'", "''")
+        conditions.append(f"{COUNTRY_KEYS[alias]} IN (SELECT Id FROM Countries WHERE {column} = '{value}')")
+    # a pruned join still drops bars whose foreign key doesn't resolve, unless a filter already does
+    filtered = [alias for alias, _, _ in filters]
+    for alias in restrict:
+        if alias not in aliases and alias not in filtered:
+            conditions.append(f"{COUNTRY_KEYS[alias]} IN (SELECT Id FROM Countries)")
+
+    lines = [f"SELECT {', '.join(select)}", "FROM Bars B"]
+    for alias in aliases:
+        lines.append(f"    JOIN Countries {alias} ON {COUNTRY_KEYS[alias]} = {alias}.Id")
+    if conditions:
+        lines.append(f"WHERE {' AND '.join(conditions)}")
+    if group_by is not None:
+        lines.append(f"GROUP BY {group_by}")
+    if having is not None:
+        lines.append(f"HAVING {having}")
+    if order_by is not None:
+        lines.append(f"ORDER BY {order_by} {order}")
+    if limit is not None:
+        lines.append(f"LIMIT {limit}")
+
+    return "\n".join(lines)
+
+
+def group1_filters(parsed_dict, alias):
+    """
+    Helper function for the query_*(.) functions. Turns the group 1 parameter into build_query(.) filters.
+
+    Parameters
+    ----------
+    parsed_dict: dict
+        Parsed command from extract_and_group_commands(.).
+    alias: str
+        Countries alias the filter applies to.
+
+    Returns
+    -------
+    list
+        Empty, or a single (alias, column, value) tuple.
+    """
+    group1 = parsed_dict["groups"][0]
+    if group1 is None:
+        return []
+    g1_key, g1_val = group1.split("=")
+
+    return [(alias, FILTER_COLUMNS[g1_key], g1_val)]
+
+
 def query_bars(parsed_dict, cmd):
     """
     Using a dict representing parsed command from extract_and_group_commands(.),
@@ -286,55 +848,49 @@ def query_bars(parsed_dict, cmd):
     if parsed_dict["groups"][2] == "number_of_bars":  # if "number_of_bars" exists, it must be user input
         raise InvalidInputError(error_msg)
 
-    query = """
-    SELECT SpecificBeanBarName, Company, C_companies.EnglishName, Rating, CocoaPercent, C_beans.EnglishName
-    FROM Bars B JOIN Countries C_companies ON B.CompanyLocationId = C_companies.Id 
-        JOIN Countries C_beans ON B.BroadBeanOriginId = C_beans.Id
-    {filters}
-    ORDER BY {key} {order}
-    LIMIT {num_entries}
-    """.format
-
-    # process group 1 and 2 parameters
-    group1, group2 = parsed_dict["groups"][:2]
-    if group1 is None:
-        filters = ""
-    else:
-        g1_key, g1_val = group1.split("=")
-        if group2 == "sell":
-            if g1_key == "country":
-                filters = f"WHERE C_companies.Alpha2 = '{g1_val}'"
-            elif g1_key == "region":
-                filters = f"WHERE C_companies.Region = '{g1_val}'"
-        elif group2 == "source":
-            if g1_key == "country":
-                filters = f"WHERE C_beans.Alpha2 = '{g1_val}'"
-            elif g1_key == "region":
-                filters = f"WHERE C_beans.Region = '{g1_val}'"
-
-    # process group 3 and 4 parameters
-    group3, group4 = parsed_dict["groups"][2:4]
-    if group3 == "ratings":
-        key = "Rating"
-    elif group3 == "cocoa":
-        key = "CocoaPercent"
-
-    if group4 == "top":
-        order = "DESC"
-    elif group4 == "bottom":
-        order = "ASC"
-
-    # process group 5 parameters
-    group5 = parsed_dict["groups"][-1]  # Note this is an int.
-    num_entries = group5
-
-    return query(filters=filters, key=key, order=order, num_entries=num_entries)
+    _, group2, group3, group4, group5 = parsed_dict["groups"]
+
+    return build_query(BAR_COLUMNS, filters=group1_filters(parsed_dict, COUNTRY_ALIASES[group2]),
+                       order_by=BAR_KEYS[group3], order=ORDERS[group4], limit=group5)
+
+
+def query_search(parsed_dict, cmd):
+    """
+    Using a dict representing parsed command from extract_and_group_commands(.),
+    validate parameters and construct SQL for high-level command "search".
+    Bars are looked up through the FTS5 index, so records have words starting with
+    all search terms in SpecificBeanBarName or Company.
+
+    Parameters
+    ----------
+    parsed_dict: dict
+        A list of parsed symbols.
+    cmd: str
+        Original command used for error message.
+
+    Returns
+    -------
+    query: str
+        The appropriate SQL for the user input.
+    """
+    assert parsed_dict["high_level"] == "search", "wrong function used"
+    error_msg = f"Command not recognized (invalid selection of parameters): {cmd}"
+    if parsed_dict["groups"][2] == "number_of_bars":  # if "number_of_bars" exists, it must be user input
+        raise InvalidInputError(error_msg)
+
+    _, group2, group3, group4, group5 = parsed_dict["groups"]
+    # quote every term as an FTS5 string so that user input is never parsed as query syntax,
+    # and match it as a prefix since FTS5 matches whole words only
+    match = " ".join('"' + term.replace('"', '""') + '"*' for term in parsed_dict["terms"])
+
+    return build_query(BAR_COLUMNS, filters=group1_filters(parsed_dict, COUNTRY_ALIASES[group2]), match=match,
+                       order_by=BAR_KEYS[group3], order=ORDERS[group4], limit=group5)
 
 
 def query_companies(parsed_dict, cmd):
     """
     Using a dict representing parsed command from extract_and_group_commands(.),
-    validate parameters and construct SQL for high-level command "countries".
+    validate parameters and construct SQL for high-level command "companies".
     Note a user can add parameters in arbitrary order.
 
     Parameters
@@ -355,56 +911,19 @@ def query_companies(parsed_dict, cmd):
     if not parsed_dict["is_user_input"][1] == -1:
         raise InvalidInputError(error_msg)
 
-    query = """
-    SELECT Company, C_companies.EnglishName, {aggregate}
-    FROM Bars B JOIN Countries C_companies ON B.CompanyLocationId = C_companies.Id 
-    {filters}
-    GROUP BY Company
-    HAVING COUNT(SpecificBeanBarName) > 4
-    ORDER BY {key} {order}
-    LIMIT {num_entries}
-    """.format
-
-    # process group 1 and 2 parameters
-    group1, group2 = parsed_dict["groups"][:2]
-    if group1 is None:
-        filters = ""
-    else:
-        g1_key, g1_val = group1.split("=")
-        if g1_key == "country":
-            filters = f"WHERE C_companies.Alpha2 = '{g1_val}'"
-        elif g1_key == "region":
-            filters = f"WHERE C_companies.Region = '{g1_val}'"
-
-    # process group 3 and 4 parameters
-    group3, group4 = parsed_dict["groups"][2:4]
-    if group3 == "ratings":
-        aggregate = "AVG(Rating) AS R_AVG"
-        key = "R_AVG"
-    elif group3 == "cocoa":
-        aggregate = "AVG(CocoaPercent) AS CP_AVG"
-        key = "CP_AVG"
-    elif group3 == "number_of_bars":
-        # aggregate = "COUNT(DISTINCT SpecificBeanBarName) AS B_CNT"
-        aggregate = "COUNT(SpecificBeanBarName) AS B_CNT"
-        key = "B_CNT"
-
-    if group4 == "top":
-        order = "DESC"
-    elif group4 == "bottom":
-        order = "ASC"
-
-    # process group 5 parameters
-    group5 = parsed_dict["groups"][-1]  # Note this is an int.
-    num_entries = group5
-
-    return query(aggregate=aggregate, filters=filters, key=key, order=order, num_entries=num_entries)
+    _, _, group3, group4, group5 = parsed_dict["groups"]
+    aggregate, key = AGGREGATES[group3]
+    select = ["Company", "C_companies.EnglishName", f"{aggregate} AS {key}"]
+
+    return build_query(select, filters=group1_filters(parsed_dict, "C_companies"), group_by="Company",
+                       having=MIN_BARS_HAVING, order_by=key, order=ORDERS[group4], limit=group5,
+                       restrict=("C_companies",))
 
 
 def query_countries(parsed_dict, cmd):
     """
     Using a dict representing parsed command from extract_and_group_commands(.),
-    validate parameters and construct SQL for high-level command "companies".
+    validate parameters and construct SQL for high-level command "countries".
     Note a user can add parameters in arbitrary order.
 
     Parameters
@@ -421,74 +940,23 @@ def query_countries(parsed_dict, cmd):
     """
     assert parsed_dict["high_level"] == "countries", "wrong function used"
     error_msg = f"Command not recognized (invalid selection of parameters): {cmd}"
+    group1, group2, group3, group4, group5 = parsed_dict["groups"]
+    # user can only filter by region
+    if group1 is not None and group1.split("=")[0] == "country":
+        raise InvalidInputError(error_msg)
 
-    query = """
-    SELECT {countries}, {regions}, {aggregate}
-    FROM Bars B JOIN Countries C_companies ON B.CompanyLocationId = C_companies.Id
-        JOIN Countries C_beans ON B.BroadBeanOriginId = C_beans.Id
-    {filters}
-    GROUP BY {grouping}
-    HAVING COUNT(SpecificBeanBarName) > 4
-    ORDER BY {key} {order}
-    LIMIT {num_entries}
-    """.format
-
-    # process group 1 and 2 parameters
-    group1, group2 = parsed_dict["groups"][:2]
-    if group2 == "sell":
-        grouping = "C_companies.EnglishName"
-        countries = "C_companies.EnglishName"
-        regions = "C_companies.Region"
-    elif group2 == "source":
-        grouping = "C_beans.EnglishName"
-        countries = "C_beans.EnglishName"
-        regions = "C_beans.Region"
+    alias = COUNTRY_ALIASES[group2]
+    aggregate, key = AGGREGATES[group3]
+    select = [f"{alias}.EnglishName", f"{alias}.Region", f"{aggregate} AS {key}"]
 
-    if group1 is None:
-        filters = ""
-    else:
-        g1_key, g1_val = group1.split("=")
-        if group2 == "sell":
-            if g1_key == "country":
-                raise InvalidInputError(error_msg)
-            elif g1_key == "region":
-                filters = f"WHERE C_companies.Region = '{g1_val}'"
-        elif group2 == "source":
-            if g1_key == "country":
-                raise InvalidInputError(error_msg)
-            elif g1_key == "region":
-                filters = f"WHERE C_beans.Region = '{g1_val}'"
-
-    # process group 3 and 4 parameters
-    group3, group4 = parsed_dict["groups"][2:4]
-    if group3 == "ratings":
-        aggregate = "AVG(Rating) AS R_AVG"
-        key = "R_AVG"
-    elif group3 == "cocoa":
-        aggregate = "AVG(CocoaPercent) AS CP_AVG"
-        key = "CP_AVG"
-    elif group3 == "number_of_bars":
-        # aggregate = "COUNT(DISTINCT SpecificBeanBarName) AS B_CNT"
-        aggregate = "COUNT(SpecificBeanBarName) AS B_CNT"
-        key = "B_CNT"
-
-    if group4 == "top":
-        order = "DESC"
-    elif group4 == "bottom":
-        order = "ASC"
-
-    # process group 5 parameters
-    group5 = parsed_dict["groups"][-1]  # Note this is an int.
-    num_entries = group5
-
-    return query(aggregate=aggregate, filters=filters, key=key, order=order, num_entries=num_entries,
-                 grouping=grouping, countries=countries, regions=regions)
+    return build_query(select, filters=group1_filters(parsed_dict, alias), group_by=f"{alias}.EnglishName",
+                       having=MIN_BARS_HAVING, order_by=key, order=ORDERS[group4], limit=group5)
 
 
 def query_regions(parsed_dict, cmd):
     """
     Using a dict representing parsed command from extract_and_group_commands(.),
-    validate parameters and construct SQL for high-level command "companies".
+    validate parameters and construct SQL for high-level command "regions".
     Note a user can add parameters in arbitrary order.
 
     Parameters
@@ -502,55 +970,20 @@ def query_regions(parsed_dict, cmd):
     -------
     query: str
         The appropriate SQL for the user input.
-        """
+    """
     assert parsed_dict["high_level"] == "regions", "wrong function used"
     error_msg = f"Command not recognized (invalid selection of parameters): {cmd}"
     # user can't input group 1 parameters
     if not parsed_dict["is_user_input"][0] == -1:
         raise InvalidInputError(error_msg)
 
-    query = """
-    SELECT {regions}, {aggregate}
-    FROM Bars B JOIN Countries C_companies ON B.CompanyLocationId = C_companies.Id
-        JOIN Countries C_beans ON B.BroadBeanOriginId = C_beans.Id
-    GROUP BY {grouping}
-    HAVING COUNT(SpecificBeanBarName) > 4
-    ORDER BY {key} {order}
-    LIMIT {num_entries}
-    """.format
-
-    # process group 1 and 2 parameters
-    _, group2 = parsed_dict["groups"][:2]
-    if group2 == "sell":
-        grouping = "C_companies.Region"
-        regions = "C_companies.Region"
-    elif group2 == "source":
-        grouping = "C_beans.Region"
-        regions = "C_beans.Region"
-
-    # process group 3 and 4 parameters
-    group3, group4 = parsed_dict["groups"][2:4]
-    if group3 == "ratings":
-        aggregate = "AVG(Rating) AS R_AVG"
-        key = "R_AVG"
-    elif group3 == "cocoa":
-        aggregate = "AVG(CocoaPercent) AS CP_AVG"
-        key = "CP_AVG"
-    elif group3 == "number_of_bars":
-        # aggregate = "COUNT(DISTINCT SpecificBeanBarName) AS B_CNT"
-        aggregate = "COUNT(SpecificBeanBarName) AS B_CNT"
-        key = "B_CNT"
-
-    if group4 == "top":
-        order = "DESC"
-    elif group4 == "bottom":
-        order = "ASC"
-
-    # process group 5 parameters
-    group5 = parsed_dict["groups"][-1]  # Note this is an int.
-    num_entries = group5
-
-    return query(aggregate=aggregate, key=key, order=order, num_entries=num_entries, grouping=grouping, regions=regions)
+    _, group2, group3, group4, group5 = parsed_dict["groups"]
+    alias = COUNTRY_ALIASES[group2]
+    aggregate, key = AGGREGATES[group3]
+    select = [f"{alias}.Region", f"{aggregate} AS {key}"]
+
+    return build_query(select, group_by=f"{alias}.Region", having=MIN_BARS_HAVING, order_by=key,
+                       order=ORDERS[group4], limit=group5)
 
 
 def load_help_text():
@@ -559,11 +992,15 @@ def load_help_text():
 
 
 # Part 2 & 3: Implement interactive prompt and plotting. We've started for you!
-def interactive_prompt():
+def interactive_prompt(timeout=None):
     help_text = load_help_text()
     response = ''
     while response != 'exit':
-        response = input('Enter a command: ')
+        try:
+            response = input('Enter a command: ')
+        except KeyboardInterrupt:  # discard the line
+            print()
+            continue
         if response == "exit":
             break
 
@@ -575,18 +1012,25 @@ def interactive_prompt():
             continue
 
         try:
-            results = process_command(response)
+            results = process_command(response, timeout=timeout, cancellable=True, entry_point="prompt")
             parsed_dict = extract_and_group_commands(response)
             high_level = parsed_dict["high_level"]
-            if not parsed_dict["barplot"]:
+            if parsed_dict["export"] is not None:
+                print(f"Exported {results} records to {parsed_dict['export']}")
+                print()
+            elif not parsed_dict["barplot"]:
                 for record in results:
                     print_record(record, high_level)
                 print()
             else:
                 barplot(results, parsed_dict["groups"][2], parsed_dict["high_level"])
-        except InvalidInputError as e:
+        except (InvalidInputError, SearchIndexError, ExportError, QueryTimeoutError, QueryCancelledError) as e:
             print(e)
             print()
+        except KeyboardInterrupt:  # Ctrl-C outside of the query, e.g. while printing
+            print()
+            print(QueryCancelledError(f"Command cancelled: {response}"))
+            print()
 
     print("\nBye!")
 
@@ -610,7 +1054,7 @@ def print_record(record, high_level, text_len=12):
     """
     text_width = text_len + 4
     numeric_width = 7
-    if high_level == "bars":
+    if high_level in ["bars", "search"]:
         for ind, entry in enumerate(record):
             if isinstance(entry, str):
                 if len(entry) > text_len:
@@ -657,13 +1101,14 @@ def barplot(records, g3_param, high_level):
 
     xvals = [record[0] for record in records]
     keys = {"bars": {"ratings": 3, "cocoa": 4},
+            "search": {"ratings": 3, "cocoa": 4},
             "companies": defaultdict(const_fact(-1)),
             "countries": defaultdict(const_fact(-1)),
             "regions": defaultdict(const_fact(-1))}
     yvals = [record[keys[high_level][g3_param]] for record in records]
     trace = go.Bar(x=xvals, y=yvals)
     data = [trace]
-    if high_level == "bars":
+    if high_level in ["bars", "search"]:
         layout = {"xaxis": {"tickangle": 20}}
     else:
         layout = {}
@@ -673,4 +1118,10 @@ def barplot(records, g3_param, high_level):
 
 # Make sure nothing runs or prints out when this file is run as a module/library
 if __name__ == "__main__":
-    interactive_prompt()
+    if sys.argv[1:] == ["build_search_index"]:
+        if build_search_index():
+            print("Search index built.")
+        else:
+            print("Search index already exists.")
+    else:
+        interactive_prompt()
@@ -0,0 +1,356 @@
+import csv
+import importlib.util
+import itertools
+import os
+import re
+import shutil
+import signal
+import sqlite3
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from proj3_choc import *
+
+# proj3_choc_features_test.py
+# Tests for features beyond the project requirements covered by proj3_choc_test.py:
+# - TestDeadline: query time budgets and cancellation.
+# - TestQueryPlan: the query_*(.) functions built on build_query(.) return the same
+#   records as the original hand-written templates.
+# - TestSearch: the "search" command.
+# - TestExport: the "export" parameter.
+
+
+def all_commands():
+    high_levels = ["", "bars", "companies", "countries", "regions"]
+    group1s = ["", "country=US", "country=GH", "region=Europe", "region=Africa"]
+    group2s = ["", "sell", "source"]
+    group3s = ["", "ratings", "cocoa", "number_of_bars"]
+    group4s = ["", "top", "bottom"]
+    group5s = ["", "3", "20"]
+    for syms in itertools.product(high_levels, group1s, group2s, group3s, group4s, group5s):
+        command = " ".join(sym for sym in syms if sym)
+        if command:
+            yield command
+
+
+class TestDeadline(unittest.TestCase):
+
+    # never finishes within the tests' time budgets
+    RUNAWAY_QUERY = """
+    WITH RECURSIVE R(X) AS (SELECT 1 UNION ALL SELECT X + 1 FROM R WHERE X < 1000000000)
+    SELECT SUM(X) FROM R
+    """
+
+    def setUp(self):
+        self.conn = sqlite3.connect(':memory:')
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_exceptions(self):
+        self.assertFalse(issubclass(QueryTimeoutError, InvalidInputError))
+        self.assertFalse(issubclass(QueryCancelledError, InvalidInputError))
+
+    def test_timeout(self):
+        self.assertRaises(QueryTimeoutError, execute_with_deadline, self.conn, self.RUNAWAY_QUERY, 'runaway',
+                          timeout=0.2)
+        # the connection is still usable afterwards
+        results = execute_with_deadline(self.conn, 'SELECT 1', 'one', timeout=0.2)
+        self.assertEqual(results, [(1,)])
+
+    def test_cancel(self):
+        prev_sigint_handler = signal.getsignal(signal.SIGINT)
+        timer = threading.Timer(0.2, os.kill, args=(os.getpid(), signal.SIGINT))
+        timer.start()
+        try:
+            self.assertRaises(QueryCancelledError, execute_with_deadline, self.conn, self.RUNAWAY_QUERY, 'runaway',
+                              timeout=10, cancellable=True)
+        finally:
+            timer.cancel()
+        self.assertIs(signal.getsignal(signal.SIGINT), prev_sigint_handler)
+
+    def test_entry_point(self):
+        with mock.patch('proj3_choc.execute_with_deadline', return_value=[]) as execute:
+            with mock.patch.dict(QUERY_TIMEOUTS, {"server": 1.5}):
+                process_command('bars', entry_point="server")
+            self.assertEqual(execute.call_args.kwargs["timeout"], 1.5)
+            process_command('bars', timeout=3, entry_point="server")
+            self.assertEqual(execute.call_args.kwargs["timeout"], 3)
+            process_command('bars')
+            self.assertIsNone(execute.call_args.kwargs["timeout"])
+
+    def test_prompt_survives_ctrl_c(self):
+        # Ctrl-C at the input line, then while printing records
+        with mock.patch('builtins.input', side_effect=[KeyboardInterrupt, 'bars', 'exit']), \
+                mock.patch('builtins.print'), \
+                mock.patch('proj3_choc.process_command', return_value=[('Chuao',)]), \
+                mock.patch('proj3_choc.print_record', side_effect=KeyboardInterrupt) as print_record:
+            interactive_prompt()
+        print_record.assert_called_once()
+
+
+# The original hand-written templates, as golden references for the query_*(.) functions.
+LEGACY_BARS = """
+    SELECT SpecificBeanBarName, Company, C_companies.EnglishName, Rating, CocoaPercent, C_beans.EnglishName
+    FROM Bars B JOIN Countries C_companies ON B.CompanyLocationId = C_companies.Id
+        JOIN Countries C_beans ON B.BroadBeanOriginId = C_beans.Id
+    {filters}
+    ORDER BY {key} {order}
+    LIMIT {num_entries}
+    """
+LEGACY_COMPANIES = """
+    SELECT Company, C_companies.EnglishName, {aggregate}
+    FROM Bars B JOIN Countries C_companies ON B.CompanyLocationId = C_companies.Id
+    {filters}
+    GROUP BY Company
+    HAVING COUNT(SpecificBeanBarName) > 4
+    ORDER BY {key} {order}
+    LIMIT {num_entries}
+    """
+LEGACY_COUNTRIES = """
+    SELECT {side}.EnglishName, {side}.Region, {aggregate}
+    FROM Bars B JOIN Countries C_companies ON B.CompanyLocationId = C_companies.Id
+        JOIN Countries C_beans ON B.BroadBeanOriginId = C_beans.Id
+    {filters}
+    GROUP BY {side}.EnglishName
+    HAVING COUNT(SpecificBeanBarName) > 4
+    ORDER BY {key} {order}
+    LIMIT {num_entries}
+    """
+LEGACY_REGIONS = """
+    SELECT {side}.Region, {aggregate}
+    FROM Bars B JOIN Countries C_companies ON B.CompanyLocationId = C_companies.Id
+        JOIN Countries C_beans ON B.BroadBeanOriginId = C_beans.Id
+    GROUP BY {side}.Region
+    HAVING COUNT(SpecificBeanBarName) > 4
+    ORDER BY {key} {order}
+    LIMIT {num_entries}
+    """
+
+
+def legacy_query(parsed_dict):
+    """
+    Fill in the original template for a command accepted by the query_*(.) functions.
+    Returns the SQL and the index of the sort key in the records.
+    """
+    high_level = parsed_dict["high_level"]
+    group1, group2, group3, group4, num_entries = parsed_dict["groups"]
+    side = "C_beans" if group2 == "source" and high_level != "companies" else "C_companies"
+    filters = ""
+    if group1 is not None:
+        g1_key, g1_val = group1.split("=")
+        column = "Alpha2" if g1_key == "country" else "Region"
+        filters = f"WHERE {side}.{column} = '{g1_val}'"
+    order = "DESC" if group4 == "top" else "ASC"
+
+    if high_level == "bars":
+        key = "Rating" if group3 == "ratings" else "CocoaPercent"
+        query = LEGACY_BARS.format(filters=filters, key=key, order=order, num_entries=num_entries)
+        return query, 3 if group3 == "ratings" else 4
+
+    aggregate, key = {"ratings": ("AVG(Rating) AS R_AVG", "R_AVG"),
+                      "cocoa": ("AVG(CocoaPercent) AS CP_AVG", "CP_AVG"),
+                      "number_of_bars": ("COUNT(SpecificBeanBarName) AS B_CNT", "B_CNT")}[group3]
+    template = {"companies": LEGACY_COMPANIES, "countries": LEGACY_COUNTRIES, "regions": LEGACY_REGIONS}[high_level]
+    query = template.format(side=side, aggregate=aggregate, filters=filters, key=key, order=order,
+                            num_entries=num_entries)
+    return query, -1
+
+
+class TestQueryPlan(unittest.TestCase):
+
+    QUERY_FUNCS = {"bars": query_bars, "companies": query_companies,
+                   "countries": query_countries, "regions": query_regions}
+
+    def test_join_pruning(self):
+        parsed_dict = extract_and_group_commands('regions sell')
+        query = query_regions(parsed_dict, 'regions sell')
+        self.assertIn('C_companies', query)
+        self.assertNotIn('C_beans', query)
+
+        parsed_dict = extract_and_group_commands('countries source region=Africa')
+        query = query_countries(parsed_dict, 'countries source region=Africa')
+        self.assertNotIn('C_companies', query)
+
+    def test_same_records(self):
+        def normalize(records):
+            # averages may differ in the last bits when rows are summed in another order
+            return [tuple(round(entry, 9) if isinstance(entry, float) else entry for entry in record)
+                    for record in records]
+
+        def without_limit(query):
+            return re.sub(r"LIMIT \d+\s*$", "", query.strip())
+
+        conn = sqlite3.connect(DBNAME)
+        cur = conn.cursor()
+        for command in all_commands():
+            try:
+                parsed_dict = extract_and_group_commands(command)
+                query = self.QUERY_FUNCS[parsed_dict["high_level"]](parsed_dict, command)
+            except InvalidInputError:
+                continue
+            golden_query, key_ind = legacy_query(parsed_dict)
+            with self.subTest(command=command):
+                # the same records overall, compared as sorted lists since ties may come in any order
+                records = normalize(cur.execute(without_limit(query)).fetchall())
+                golden_records = normalize(cur.execute(without_limit(golden_query)).fetchall())
+                self.assertEqual(sorted(records, key=repr), sorted(golden_records, key=repr))
+                # and the same sort keys in the same order up to the limit
+                records = normalize(cur.execute(query).fetchall())
+                golden_records = normalize(cur.execute(golden_query).fetchall())
+                self.assertEqual([record[key_ind] for record in records],
+                                 [record[key_ind] for record in golden_records])
+        conn.close()
+
+
+class TestSearch(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # build the index in a copy, leaving the real database untouched
+        cls.tmp_dir = tempfile.TemporaryDirectory()
+        dbname = os.path.join(cls.tmp_dir.name, os.path.basename(DBNAME))
+        shutil.copy(DBNAME, dbname)
+        cls.dbname_patcher = mock.patch('proj3_choc.DBNAME', dbname)
+        cls.dbname_patcher.start()
+        build_search_index()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.dbname_patcher.stop()
+        cls.tmp_dir.cleanup()
+
+    def test_search(self):
+        results = process_command('search Porcelana ratings top 5')
+        self.assertGreater(len(results), 0)
+        self.assertLessEqual(len(results), 5)
+        for record in results:
+            self.assertTrue('porcelana' in record[0].lower() or 'porcelana' in record[1].lower())
+        ratings = [record[3] for record in results]
+        self.assertEqual(ratings, sorted(ratings, reverse=True))
+
+        # terms match words by prefix
+        self.assertEqual(process_command('search Porcel ratings top 5'), results)
+
+        self.assertRaises(InvalidInputError, extract_and_group_commands, 'search')
+        self.assertRaises(InvalidInputError, process_command, 'search Porcelana number_of_bars')
+
+    def test_build_search_index(self):
+        self.assertFalse(build_search_index())
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            dbname = os.path.join(tmp_dir, 'empty.sqlite')
+            conn = sqlite3.connect(dbname)
+            conn.execute('CREATE TABLE Countries (Id INTEGER PRIMARY KEY, Alpha2 TEXT, EnglishName TEXT, Region TEXT)')
+            conn.execute('CREATE TABLE Bars (Id INTEGER PRIMARY KEY, Company TEXT, SpecificBeanBarName TEXT, '
+                         'CocoaPercent REAL, CompanyLocationId INTEGER, Rating REAL, BroadBeanOriginId INTEGER)')
+            conn.close()
+            with mock.patch('proj3_choc.DBNAME', dbname):
+                self.assertRaises(SearchIndexError, process_command, 'search Porcelana')
+                self.assertTrue(build_search_index())
+                self.assertEqual(process_command('search Porcelana'), [])
+
+
+class TestExport(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_export_csv(self):
+        path = os.path.join(self.tmp_dir.name, 'out.csv')
+        num_records = process_command(f'countries source cocoa export={path}')
+        results = process_command('countries source cocoa')
+        self.assertEqual(num_records, len(results))
+        with open(path, newline='') as f:
+            rows = list(csv.reader(f))
+        self.assertEqual(rows[0], ['Country', 'Region', 'CP_AVG'])
+        self.assertEqual(rows[1:], [[str(entry) for entry in record] for record in results])
+
+        self.assertRaises(InvalidInputError, extract_and_group_commands, 'bars export=out.txt')
+        self.assertRaises(InvalidInputError, extract_and_group_commands, 'bars export=out.csv barplot')
+
+    @unittest.skipUnless(importlib.util.find_spec('pyarrow'), 'pyarrow not installed')
+    def test_export_arrow(self):
+        import pyarrow.ipc
+        import pyarrow.parquet
+        results = process_command('companies number_of_bars top 20')
+        path = os.path.join(self.tmp_dir.name, 'out.parquet')
+        process_command(f'companies number_of_bars top 20 export={path}')
+        table = pyarrow.parquet.read_table(path)
+        self.assertEqual(str(table.schema.field('B_CNT').type), 'int64')
+        self.assertEqual([tuple(row.values()) for row in table.to_pylist()], results)
+
+        path = os.path.join(self.tmp_dir.name, 'out.arrow')
+        process_command(f'companies number_of_bars top 20 export={path}')
+        table = pyarrow.ipc.open_file(path).read_all()
+        self.assertEqual([tuple(row.values()) for row in table.to_pylist()], results)
+
+    def test_export_columns(self):
+        python_types = {"string": str, "float64": float, "int64": int}
+        for command in all_commands():
+            try:
+                parsed_dict = extract_and_group_commands(command)
+                results = process_command(command)
+            except InvalidInputError:
+                continue
+            columns = export_columns(parsed_dict)
+            with self.subTest(command=command):
+                for record in results:
+                    self.assertEqual(len(record), len(columns))
+                    for entry, (_, type_name) in zip(record, columns):
+                        if entry is not None:
+                            self.assertIsInstance(entry, python_types[type_name])
+
+    def test_failed_export(self):
+        class FailingCursor:
+            # yields one batch, then fails like a timed out query
+            def __init__(self):
+                self.batches = [[('Chuao', 'Amedei', 'Italy', 5.0, 0.7, 'Venezuela')]]
+
+            def fetchmany(self, size):
+                if len(self.batches) == 0:
+                    raise sqlite3.OperationalError('interrupted')
+                return self.batches.pop()
+
+        path = os.path.join(self.tmp_dir.name, 'keep.csv')
+        with open(path, 'w') as f:
+            f.write('keep')
+        columns = export_columns(extract_and_group_commands('bars'))
+        self.assertRaises(sqlite3.OperationalError, export_records, FailingCursor(), path, columns, batch_size=1)
+        with open(path) as f:
+            self.assertEqual(f.read(), 'keep')
+        self.assertEqual(os.listdir(self.tmp_dir.name), ['keep.csv'])
+
+        missing_dir_path = os.path.join(self.tmp_dir.name, 'missing', 'out.csv')
+        self.assertRaises(ExportError, process_command, f'bars export={missing_dir_path}')
+
+    @unittest.skipIf(importlib.util.find_spec('pyarrow'), 'pyarrow installed')
+    def test_export_without_pyarrow(self):
+        path = os.path.join(self.tmp_dir.name, 'keep.parquet')
+        with open(path, 'w') as f:
+            f.write('keep')
+        self.assertRaises(ExportError, process_command, f'bars export={path}')
+        with open(path) as f:
+            self.assertEqual(f.read(), 'keep')
+
+    def test_export_timeout(self):
+        path = os.path.join(self.tmp_dir.name, 'out.csv')
+        with mock.patch('proj3_choc.execute_with_deadline', return_value=0) as execute:
+            process_command(f'bars export={path}', entry_point="prompt")
+            self.assertEqual(execute.call_args.kwargs["timeout"], EXPORT_TIMEOUTS["prompt"])
+
+    def test_export_server(self):
+        # a server's budget can't be lifted, nor files written, by adding "export" to the command
+        path = os.path.join(self.tmp_dir.name, 'out.csv')
+        with mock.patch('proj3_choc.execute_with_deadline', return_value=0) as execute:
+            self.assertRaises(ExportError, process_command, f'bars export={path}', entry_point="server")
+            execute.assert_not_called()
+        self.assertFalse(os.path.exists(path))
+
+
+if __name__ == "__main__":
+    unittest.main()